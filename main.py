@@ -1,40 +1,120 @@
 import os
 import uuid
+import asyncio
+import shutil
 import subprocess
+import json
+import heapq
+import hashlib
 import tempfile
-from typing import Optional
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from urllib.parse import urlparse
+import queue
+import functools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response
+from fastapi.routing import APIRoute
 from pydantic import BaseModel
 import httpx
+import aiofiles
+import orjson
+
+class ORJSONRequest(Request):
+    """リクエストボディのJSONをorjsonでパースする（テロップが数百件になることがあるため）"""
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class ORJSONRoute(APIRoute):
+    def get_route_handler(self):
+        original_handler = super().get_route_handler()
+
+        async def handler(request: Request):
+            return await original_handler(ORJSONRequest(request.scope, request.receive))
+
+        return handler
+
+class OutputFileResponse(FileResponse):
+    """出力動画の配信用（1回の読み書きを256KiBにしてシステムコールを減らす）"""
+    chunk_size = 256 * 1024
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # ダウンロード用のクライアントは使い回してTCP/TLS接続をプールする
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,
+        # 接続できないホストはすぐに諦め、転送中の待ちだけ長めに許す
+        timeout=httpx.Timeout(connect=5.0, read=60.0, write=30.0, pool=5.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+    await start_url_cache_janitor()
+    await prepare_scratch_pool()
+    await seed_output_index()
+    await start_job_workers()
+    try:
+        yield
+    finally:
+        # ダウンロード中のジョブが閉じたクライアントを使わないよう、先にワーカー・janitor・共有ダウンロードを止める
+        background_tasks = [
+            t for t in [*worker_tasks, url_cache_janitor_task, *INFLIGHT_DOWNLOADS.values()] if t is not None
+        ]
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        worker_tasks.clear()
+        await app.state.http.aclose()
+
+app = FastAPI(title="FFmpeg Video Combiner API", default_response_class=ORJSONResponse, lifespan=lifespan)
+app.router.route_class = ORJSONRoute
 
-app = FastAPI(title="FFmpeg Video Combiner API")
+# 許可するオリジンはカンマ区切りで指定（未指定なら全オリジン）。メソッドとヘッダを明示してプリフライトを1日キャッシュさせる
+CORS_ALLOW_ORIGINS = [o.strip() for o in os.environ.get("CORS_ALLOW_ORIGINS", "").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ALLOW_ORIGINS,
+    allow_origin_regex=None if CORS_ALLOW_ORIGINS else ".*",
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
+    max_age=86400,
 )
 
-TEMP_DIR = tempfile.gettempdir()
-OUTPUT_DIR = os.path.join(TEMP_DIR, "ffmpeg_output")
+# 動画ファイルはRAM上のtmpfsであることが多い/tmpではなくディスク上の作業ディレクトリに置く
+WORK_DIR = os.environ.get("FFMPEG_WORK_DIR", "/var/tmp/ffmpeg_work")
+# 出力は作業ディレクトリ内で書き上げてから同じファイルシステム内のrenameで公開する
+RENDER_DIR = os.path.join(WORK_DIR, "ffmpeg_render")
+OUTPUT_DIR = os.path.join(WORK_DIR, "ffmpeg_output")
 FONT_DIR = "/usr/share/fonts/truetype"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# nginxの前段がある場合は /download をX-Accel-Redirectで返す。nginx側の設定例:
+#   location /internal-output/ { internal; alias /var/tmp/ffmpeg_work/ffmpeg_output/; sendfile on; }
+SERVE_VIA_XACCEL = os.environ.get("USE_XACCEL") == "1"
+XACCEL_PREFIX = os.environ.get("XACCEL_PREFIX", "/internal-output/")
+
 # === Models ===
 
+# libx264の-preset（速いほど圧縮率は下がる）
+X264Preset = Literal["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+
 class CombineRequest(BaseModel):
     video_url: str
     audio_url: str
     output_format: str = "mp4"
+    audio_mode: Literal["mix", "replace"] = "mix"  # mix: keep source audio under BGM, replace: swap audio track
 
 class ImageToVideoRequest(BaseModel):
     image_url: str
     audio_url: str
     output_format: str = "mp4"
+    encode_speed: Optional[X264Preset] = None  # libx264 preset override (default: ultrafast)
 
 class CaptionStyle(BaseModel):
     font: str = "regular"  # regular, bold, extra-bold
@@ -65,6 +145,8 @@ class CombineWithCaptionsRequest(BaseModel):
     captions: list[Caption]
     caption_styles: CaptionStyles = CaptionStyles()
     output_format: str = "mp4"
+    hardcode: bool = True  # False: mux captions as a subtitle track (mp4/mov/m4v/mkv) without re-encoding video
+    encode_speed: Optional[X264Preset] = None  # libx264 preset override (default: veryfast)
 
 class CombineResponse(BaseModel):
     success: bool
@@ -72,27 +154,341 @@ class CombineResponse(BaseModel):
     message: str
     output_url: str | None = None
 
+class JobStatusResponse(BaseModel):
+    job_id: str
+    state: str  # pending, running, done, failed
+    output_url: str | None = None
+    error: str | None = None
+
 # === Helper Functions ===
 
-async def download_file(url: str, dest_path: str) -> bool:
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# 同じURL（BGMやロゴ画像など）は再ダウンロードせずにキャッシュからハードリンクする
+URL_CACHE_DIR = os.environ.get("URL_CACHE_DIR", "/var/cache/ffmpeg_combiner")
+# 内容の更新は検知しないので、同じURLの中身が差し替わらない運用のときだけ有効にする（例: 5GiBなら5368709120）
+URL_CACHE_MAX_BYTES = int(os.environ.get("URL_CACHE_MAX_BYTES", "0"))  # 0で無効
+URL_CACHE_JANITOR_INTERVAL = 60
+url_cache_janitor_task: asyncio.Task | None = None
+
+if URL_CACHE_MAX_BYTES > 0:
+    try:
+        os.makedirs(URL_CACHE_DIR, exist_ok=True)
+    except OSError as e:
+        print(f"URL cache disabled: {e}")
+        URL_CACHE_MAX_BYTES = 0
+
+def url_key(url: str) -> str:
+    return hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+
+def url_cache_path(url: str) -> str:
+    return os.path.join(URL_CACHE_DIR, url_key(url))
+
+def link_file(src_path: str, dest_path: str):
+    """src_pathをdest_pathにハードリンクする（別ファイルシステムならコピー）"""
+    tmp_path = f"{dest_path}.{uuid.uuid4().hex[:8]}.link"
+    try:
+        os.link(src_path, tmp_path)
+    except OSError as e:
+        if not os.path.exists(src_path):
+            raise
+        print(f"Hard link failed, copying instead: {e}")
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+def evict_url_cache():
+    """キャッシュの合計サイズが上限を超えていれば古いものから削除"""
+    entries = []
+    total = 0
+    with os.scandir(URL_CACHE_DIR) as it:
+        for entry in it:
+            if not entry.is_file() or entry.name.endswith(".part"):
+                continue
+            st = entry.stat()
+            entries.append((st.st_atime, st.st_size, entry.path))
+            total += st.st_size
+    heapq.heapify(entries)
+    while total > URL_CACHE_MAX_BYTES and entries:
+        _, size, path = heapq.heappop(entries)
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+async def url_cache_janitor():
+    while True:
+        await asyncio.sleep(URL_CACHE_JANITOR_INTERVAL)
+        try:
+            await asyncio.to_thread(evict_url_cache)
+        except Exception as e:
+            print(f"URL cache eviction failed: {e}")
+
+URL_CACHE_STALE_PART_AGE = 3600
+
+def remove_stale_parts():
+    """強制終了などで残った書きかけの.partを削除（他プロセスが書き込み中のものは残す）"""
+    expires = time.time() - URL_CACHE_STALE_PART_AGE
+    with os.scandir(URL_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".part") and entry.stat().st_mtime < expires:
+                remove_files(entry.path)
+
+async def start_url_cache_janitor():
+    global url_cache_janitor_task
+    if URL_CACHE_MAX_BYTES > 0:
+        await asyncio.to_thread(remove_stale_parts)
+        url_cache_janitor_task = asyncio.create_task(url_cache_janitor())
+
+DOWNLOAD_RETRIES = 3
+
+def is_retryable_download_error(e: Exception) -> bool:
+    """一時的な失敗（接続・転送エラーと5xx）ならTrue"""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+async def fetch_file(url: str, dest_path: str, client: httpx.AsyncClient) -> bool:
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            # 全体をメモリに載せず1MiBずつディスクへ書き出す
+            async with client.stream("GET", url) as response:
+                response.raise_for_status()
+                async with aiofiles.open(dest_path, "wb", buffering=DOWNLOAD_CHUNK_SIZE) as f:
+                    async for chunk in response.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        await f.write(chunk)
+            return True
+        except Exception as e:
+            if attempt + 1 < DOWNLOAD_RETRIES and is_retryable_download_error(e):
+                print(f"Download error, retrying: {e}")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+                continue
+            print(f"Download error: {e}")
+            return False
+    return False
+
+# 書き込み中の共有ファイル（キャッシュまたはINFLIGHT_DIR内のパス -> ダウンロードタスク）
+INFLIGHT_DOWNLOADS: dict[str, asyncio.Task] = {}
+
+# キャッシュ無効時に同じURLの同時ダウンロードをまとめるための置き場（スクラッチと同じファイルシステムに置く）
+INFLIGHT_DIR = os.path.join(WORK_DIR, "ffmpeg_inflight")
+INFLIGHT_SHARED: dict[str, str] = {}  # url_key -> 共有ファイルのパス
+INFLIGHT_USERS: dict[str, int] = {}  # 共有ファイルのパス -> 待っているジョブ数
+
+async def fetch_shared_file(url: str, shared_path: str, client: httpx.AsyncClient) -> bool:
+    # 一時ファイルに落としてからrenameして、途中のファイルを他のジョブに見せない
+    part_path = f"{shared_path}.{uuid.uuid4().hex[:8]}.part"
     try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.get(url, follow_redirects=True)
-            response.raise_for_status()
-            with open(dest_path, "wb") as f:
-                f.write(response.content)
+        if not await fetch_file(url, part_path, client):
+            return False
+        os.replace(part_path, shared_path)
         return True
-    except Exception as e:
-        print(f"Download error: {e}")
-        return False
+    finally:
+        remove_files(part_path)
+
+def _forget_shared(key: str, shared_path: str):
+    if INFLIGHT_SHARED.get(key) == shared_path:
+        del INFLIGHT_SHARED[key]
+
+async def download_shared(url: str, dest_path: str, client: httpx.AsyncClient) -> bool:
+    """キャッシュ無効時も、同時に走る同じURLのダウンロードは1回にまとめて各ジョブへハードリンクする"""
+    key = url_key(url)
+    shared_path = INFLIGHT_SHARED.get(key)
+    if shared_path is None:
+        shared_path = os.path.join(INFLIGHT_DIR, f"{key}.{uuid.uuid4().hex[:8]}")
+        task = asyncio.create_task(fetch_shared_file(url, shared_path, client))
+        INFLIGHT_SHARED[key] = shared_path
+        INFLIGHT_DOWNLOADS[shared_path] = task
+        task.add_done_callback(lambda _: (_forget_shared(key, shared_path), INFLIGHT_DOWNLOADS.pop(shared_path, None)))
+    else:
+        task = INFLIGHT_DOWNLOADS[shared_path]
+        print(f"Waiting for in-flight download: {url}")
+    INFLIGHT_USERS[shared_path] = INFLIGHT_USERS.get(shared_path, 0) + 1
+    try:
+        if not await asyncio.shield(task):
+            return False
+        await asyncio.to_thread(link_file, shared_path, dest_path)
+        return True
+    except OSError as e:
+        print(f"Shared download link failed: {e}")
+        return await fetch_file(url, dest_path, client)
+    finally:
+        # 最後のジョブが抜けたら共有ファイルを消す（途中で全員キャンセルされたらダウンロードも止める）
+        INFLIGHT_USERS[shared_path] -= 1
+        if INFLIGHT_USERS[shared_path] == 0:
+            del INFLIGHT_USERS[shared_path]
+            _forget_shared(key, shared_path)
+            task.cancel()
+            remove_files(shared_path)
+
+async def download_file(url: str, dest_path: str, client: httpx.AsyncClient) -> bool:
+    if URL_CACHE_MAX_BYTES <= 0:
+        return await download_shared(url, dest_path, client)
+
+    cache_path = url_cache_path(url)
+    try:
+        # LRU判定用にアクセス時刻を更新（noatimeマウント対策）。無ければキャッシュミス
+        os.utime(cache_path)
+        print(f"URL cache hit: {url}")
+    except FileNotFoundError:
+        # 同じURLを別のジョブがダウンロード中ならその完了を待つ（呼び出し元がキャンセルされても続くようにタスクで持つ）
+        task = INFLIGHT_DOWNLOADS.get(cache_path)
+        if task is None:
+            task = asyncio.create_task(fetch_shared_file(url, cache_path, client))
+            INFLIGHT_DOWNLOADS[cache_path] = task
+            task.add_done_callback(lambda _: INFLIGHT_DOWNLOADS.pop(cache_path, None))
+        else:
+            print(f"Waiting for in-flight download: {url}")
+        if not await asyncio.shield(task):
+            return False
 
+    try:
+        # 別ファイルシステムだとコピーになるのでイベントループを止めないようにスレッドで行う
+        await asyncio.to_thread(link_file, cache_path, dest_path)
+        return True
+    except OSError as e:
+        # リンク直前にキャッシュが削除された場合など
+        print(f"URL cache link failed: {e}")
+        return await fetch_file(url, dest_path, client)
+
+async def gather_downloads(*downloads) -> list[bool]:
+    """ダウンロードを同時に走らせ、1つでも失敗したら残りはキャンセルする"""
+    tasks = [asyncio.ensure_future(d) for d in downloads]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            if not await next_done:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    # キャンセルした分は失敗扱いにしない（実際に失敗した方のエラーを返すため）
+    return [task.cancelled() or task.result() for task in tasks]
+
+# スクラッチファイルの拡張子として使う音声の拡張子
+AUDIO_SUFFIXES = {".mp3", ".m4a", ".aac", ".wav", ".ogg", ".opus", ".flac"}
+
+def url_suffix(url: str, allowed: set[str], default: str) -> str:
+    """URLのパスから拡張子を取り出す（想定外の拡張子ならdefault）"""
+    suffix = os.path.splitext(urlparse(url).path)[1].lower()
+    return suffix if suffix in allowed else default
+
+def faststart_args(output_path: str) -> list[str]:
+    """MP4/MOVはmoovを先頭に置いてダウンロード途中から再生できるようにする"""
+    if output_path.lower().endswith((".mp4", ".mov", ".m4v")):
+        return ["-movflags", "+faststart"]
+    return []
+
+async def _noop(value: bool) -> bool:
+    """gather_downloadsで省略したダウンロードの代わりに使う"""
+    return value
+
+@functools.lru_cache(maxsize=1)
 def get_ffmpeg_version() -> str:
+    """FFmpegのバージョン文字列（プロセス中は変わらないので1回だけ取得する）"""
     try:
         result = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True)
         return result.stdout.split('\n')[0]
     except Exception:
         return "FFmpeg not found"
 
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+def try_hw_encode(global_args: list[str], encode_args: list[str]) -> bool:
+    """1フレームだけ試しにエンコードしてハードウェアエンコーダが動くか確認"""
+    cmd = (
+        ["ffmpeg", "-hide_banner"] + global_args
+        + ["-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.1", "-frames:v", "1"]
+        + encode_args + ["-f", "null", "-"]
+    )
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+    return result.returncode == 0
+
+def detect_encoder_mode() -> str:
+    """使えるエンコーダを nvenc / vaapi / qsv / videotoolbox / x264 のいずれかで返す"""
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True, text=True, timeout=10
+        )
+        encoders = result.stdout
+        # ビルドに含まれていてもGPUが無い環境があるので実際にエンコードして確認
+        if "h264_nvenc" in encoders and try_hw_encode([], ["-c:v", "h264_nvenc"]):
+            return "nvenc"
+        if (
+            "h264_vaapi" in encoders
+            and os.path.exists(VAAPI_DEVICE)
+            and try_hw_encode(["-vaapi_device", VAAPI_DEVICE], ["-vf", "format=nv12,hwupload", "-c:v", "h264_vaapi"])
+        ):
+            return "vaapi"
+        if "h264_qsv" in encoders and try_hw_encode([], ["-vf", "format=nv12", "-c:v", "h264_qsv"]):
+            return "qsv"
+        if "h264_videotoolbox" in encoders and try_hw_encode([], ["-c:v", "h264_videotoolbox"]):
+            return "videotoolbox"
+    except Exception as e:
+        print(f"Encoder detection failed: {e}")
+    return "x264"
+
+# 起動時に一度だけ判定してキャッシュ
+ENCODER_MODE = detect_encoder_mode()
+print(f"Video encoder mode: {ENCODER_MODE}")
+print(f"FFmpeg version: {get_ffmpeg_version()}")
+
+def _video_encoder_args(
+    filters: str = "",
+    hw_decode: bool = True,
+    preset: str | None = None
+) -> tuple[list[str], str, list[str]]:
+    """ENCODER_MODEに応じて (入力前のhwaccel引数, ビデオフィルタ, -c:v引数) を返す
+
+    hw_decode=False は静止画ループなどGPUでデコードしない入力用。
+    presetはlibx264のときだけ使う。
+    ass/drawtextなどのCPUフィルタはGPUフレームをダウンロードしてから適用する。
+    """
+    if ENCODER_MODE == "nvenc":
+        codec_args = ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "ll", "-rc", "vbr", "-b:v", "4M"]
+        if not hw_decode:
+            return [], filters, codec_args + ["-pix_fmt", "yuv420p"]
+        input_args = ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"]
+        vf = f"hwdownload,format=nv12,{filters},hwupload_cuda" if filters else ""
+        return input_args, vf, codec_args
+
+    if ENCODER_MODE == "vaapi":
+        codec_args = ["-c:v", "h264_vaapi", "-b:v", "4M"]
+        if not hw_decode:
+            vf = f"{filters},format=nv12,hwupload" if filters else "format=nv12,hwupload"
+            return ["-vaapi_device", VAAPI_DEVICE], vf, codec_args
+        input_args = [
+            "-hwaccel", "vaapi", "-hwaccel_device", VAAPI_DEVICE,
+            "-hwaccel_output_format", "vaapi",
+        ]
+        if filters:
+            vf = f"hwdownload,format=nv12,{filters},format=nv12|vaapi,hwupload"
+        else:
+            vf = "format=nv12|vaapi,hwupload"
+        return input_args, vf, codec_args
+
+    # QSV/VideoToolboxはデコードとフィルタはCPUで行い、システムメモリのフレームをそのまま渡す
+    if ENCODER_MODE == "qsv":
+        codec_args = ["-c:v", "h264_qsv", "-preset", "veryfast", "-b:v", "4M"]
+        vf = f"{filters},format=nv12" if filters else "format=nv12"
+        return [], vf, codec_args
+
+    if ENCODER_MODE == "videotoolbox":
+        codec_args = ["-c:v", "h264_videotoolbox", "-b:v", "4M", "-pix_fmt", "yuv420p"]
+        return [], filters, codec_args
+
+    # 保存用ではなく合成してすぐ返す用途なので速いプリセットを使う
+    if not hw_decode:
+        codec_args = [
+            "-c:v", "libx264", "-preset", preset or "ultrafast", "-crf", "23",
+            "-tune", "stillimage", "-pix_fmt", "yuv420p",
+        ]
+    else:
+        codec_args = ["-c:v", "libx264", "-preset", preset or "veryfast", "-crf", "20"]
+    return [], filters, codec_args
+
+@functools.lru_cache(maxsize=None)
 def get_font_file(font_type: str) -> str:
     """フォントタイプに応じたフォントファイルを返す"""
     # Noto Sans CJK JP フォントマッピング
@@ -139,29 +535,101 @@ def get_font_file(font_type: str) -> str:
 
     return "DejaVuSans"  # FFmpeg default
 
-def get_position_y(position: str, video_height: int = 720) -> str:
-    """位置に応じたY座標を返す"""
-    positions = {
-        "top": "50",
-        "center": f"(h-text_h)/2",
-        "bottom": f"h-text_h-50",
-    }
-    return positions.get(position, positions["bottom"])
+@functools.lru_cache(maxsize=None)
+def font_file_exists(font_file: str) -> bool:
+    """フォントファイルの存在確認（解決済みのパスごとに1回だけ）"""
+    return bool(font_file) and os.path.exists(font_file)
+
+# 起動時にフォント解決を済ませておく
+for _font_type in ("regular", "bold", "extra-bold"):
+    font_file_exists(get_font_file(_font_type))
+
+# 表示位置 → ASSのAlignment（テンキー配置）
+ASS_ALIGNMENT = {
+    "top": 8,
+    "center": 5,
+    "bottom": 2,
+}
+
+# 出力形式 → 字幕トラックのコーデック（焼き込まずに多重化できる形式のみ）
+SOFT_SUBTITLE_CODECS = {
+    "mp4": "mov_text",
+    "mov": "mov_text",
+    "m4v": "mov_text",
+    "mkv": "ass",
+}
+
+# フォントタイプ → (ASSのFontname, Bold)
+ASS_FONT_MAP = {
+    "regular": ("Noto Sans CJK JP", 0),
+    "bold": ("Noto Sans CJK JP", -1),
+    "extra-bold": ("Noto Sans CJK JP Black", 0),
+}
+
+ASS_COLOR_NAMES = {
+    "white": "FFFFFF",
+    "black": "000000",
+    "red": "FF0000",
+    "yellow": "FFFF00",
+    "blue": "0000FF",
+    "green": "008000",
+    "lime": "00FF00",
+    "cyan": "00FFFF",
+    "magenta": "FF00FF",
+    "orange": "FFA500",
+    "pink": "FFC0CB",
+    "gray": "808080",
+    "grey": "808080",
+}
+
+# FFmpegフィルタのオプション値用エスケープ表（1回のtranslateで済ませる）
+_ESCAPE_TABLE = str.maketrans({
+    "\\": "\\\\",
+    ":": "\\:",
+    "'": "\\'",
+    "[": "\\[",
+    "]": "\\]",
+})
 
 def escape_text_for_ffmpeg(text: str) -> str:
-    """FFmpeg drawtext用にテキストをエスケープ"""
-    # FFmpegのdrawtextフィルタ用エスケープ
-    text = text.replace("\\", "\\\\")
-    text = text.replace(":", "\\:")
-    text = text.replace("'", "\\'")
-    text = text.replace("[", "\\[")
-    text = text.replace("]", "\\]")
-    return text
-
-def build_drawtext_filter(captions: list[Caption], styles: CaptionStyles) -> str:
-    """複数のテロップ用のdrawtextフィルタを構築"""
-    filters = []
-
+    """FFmpegフィルタのオプション値用にテキストをエスケープ"""
+    return text.translate(_ESCAPE_TABLE)
+
+# ASSのオーバーライドタグとして解釈されないようにする
+_ASS_ESCAPE_TABLE = str.maketrans({
+    "\\": "＼",
+    "{": "\\{",
+    "}": "\\}",
+    "\n": "\\N",
+})
+
+def escape_text_for_ass(text: str) -> str:
+    """ASSのDialogue用にテキストをエスケープ"""
+    return text.translate(_ASS_ESCAPE_TABLE)
+
+def to_ass_color(color: str, alpha: int = 0) -> str:
+    """FFmpeg形式の色指定(white, #RRGGBB, 0xRRGGBB)をASSの&HAABBGGRRに変換"""
+    name = color.split("@")[0].strip().lower()
+    if name.startswith("#"):
+        rgb = name[1:]
+    elif name.startswith("0x"):
+        rgb = name[2:]
+    else:
+        rgb = ASS_COLOR_NAMES.get(name, "FFFFFF")
+    if len(rgb) != 6:
+        rgb = "FFFFFF"
+    return f"&H{alpha:02X}{rgb[4:6]}{rgb[2:4]}{rgb[0:2]}".upper()
+
+def format_ass_time(seconds: float) -> str:
+    """秒をASSの H:MM:SS.cc 形式にする"""
+    centis = max(0, int(round(seconds * 100)))
+    hours, centis = divmod(centis, 360000)
+    minutes, centis = divmod(centis, 6000)
+    secs, centis = divmod(centis, 100)
+    return f"{hours}:{minutes:02d}:{secs:02d}.{centis:02d}"
+
+def build_ass_file(captions: list[Caption], styles: CaptionStyles, ass_path: str, width: int, height: int) -> None:
+    """テロップをASS字幕ファイルとして書き出す"""
     style_map = {
         "default": styles.default,
         "emphasis": styles.emphasis,
@@ -169,164 +637,331 @@ def build_drawtext_filter(captions: list[Caption], styles: CaptionStyles) -> str
         "gentle": styles.gentle,
     }
 
+    # PlayResを動画サイズに合わせてフォントサイズ等をピクセル指定にする
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {width}",
+        f"PlayResY: {height}",
+        "WrapStyle: 2",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+        "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+        "Alignment, MarginL, MarginR, MarginV, Encoding",
+    ]
+    for name, style in style_map.items():
+        font_name, bold = ASS_FONT_MAP.get(style.font, ASS_FONT_MAP["regular"])
+        # 影は半透明の黒
+        shadow = 2 if style.shadow else 0
+        lines.append(
+            f"Style: {name},{font_name},{style.size},{to_ass_color(style.color)},{to_ass_color(style.color)},"
+            f"{to_ass_color(style.outline_color)},{to_ass_color('black', 0x80)},{bold},0,0,0,100,100,0,0,1,"
+            f"{style.outline_width},{shadow},2,10,10,50,1"
+        )
+
+    lines += [
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+    ]
     for caption in captions:
-        style = style_map.get(caption.style, styles.default)
-        escaped_text = escape_text_for_ffmpeg(caption.text)
-        font_file = get_font_file(style.font)
-        y_pos = get_position_y(caption.position)
-
-        # 影の設定
-        shadow_settings = ""
-        if style.shadow:
-            shadow_settings = ":shadowcolor=black@0.5:shadowx=2:shadowy=2"
-
-        # フォントファイルが存在する場合のみ指定
-        if font_file and os.path.exists(font_file):
-            font_setting = f"fontfile='{font_file}'"
-        else:
-            # フォントがない場合はfontを使用
-            font_setting = "font='sans-serif'"
-            print(f"Font file not found, using default: {font_file}")
+        style_name = caption.style if caption.style in style_map else "default"
+        alignment = ASS_ALIGNMENT.get(caption.position, ASS_ALIGNMENT["bottom"])
 
         # テキストを複数行に分割（20文字ごと）
         max_chars = 20
-        lines = [escaped_text[i:i+max_chars] for i in range(0, len(escaped_text), max_chars)]
+        text_lines = [caption.text[i:i+max_chars] for i in range(0, len(caption.text), max_chars)]
+        text = "\\N".join(escape_text_for_ass(line) for line in text_lines)
 
-        for line_idx, line_text in enumerate(lines):
-            line_offset = (len(lines) - 1 - line_idx) * 30  # 行間30px
-            if line_offset > 0:
-                line_y_expr = f"({y_pos})-{line_offset}"
-            else:
-                line_y_expr = y_pos
-            filter_str = (
-                f"drawtext={font_setting}"
-                f":text='{line_text}'"
-                f":fontsize={style.size}"
-                f":fontcolor={style.color}"
-                f":borderw={style.outline_width}"
-                f":bordercolor={style.outline_color}"
-                f":x=(w-text_w)/2"
-                f":y={line_y_expr}"
-                f":enable='between(t,{caption.start_time},{caption.end_time})'"
-                f"{shadow_settings}"
-            )
-            filters.append(filter_str)
+        lines.append(
+            f"Dialogue: 0,{format_ass_time(caption.start_time)},{format_ass_time(caption.end_time)},"
+            f"{style_name},,0,0,0,,{{\\an{alignment}}}{text}"
+        )
 
-    return ",".join(filters)
+    with open(ass_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+async def build_caption_filter(captions: list[Caption], styles: CaptionStyles, video_path: str, ass_path: str) -> str:
+    """ASSファイルを書き出してテロップ用のassフィルタを返す"""
+    width, height = await probe_video_size(video_path)
+    build_ass_file(captions, styles, ass_path, width, height)
+
+    filter_str = f"ass=filename='{escape_text_for_ffmpeg(ass_path)}'"
+    # Notoフォントのディレクトリをlibassに渡す
+    font_file = get_font_file("regular")
+    if font_file_exists(font_file):
+        filter_str += f":fontsdir='{escape_text_for_ffmpeg(os.path.dirname(font_file))}'"
+    else:
+        print(f"Font file not found, using fontconfig default: {font_file}")
+    return filter_str
+
+PROBE_TIMEOUT = 30
+
+async def run_probe(cmd: list[str], timeout: float = PROBE_TIMEOUT) -> tuple[str, str]:
+    """ffprobeを非同期で実行して (stdout, stderr) を返す（イベントループを止めない）"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        proc.kill()
+        await proc.wait()
+        raise
+    return stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+async def probe_video_size(video_path: str) -> tuple[int, int]:
+    """表示時の動画サイズ (width, height) を返す（回転メタデータを考慮）"""
+    probe_cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "stream=width,height:stream_tags=rotate:stream_side_data=rotation",
+        "-of", "json", video_path
+    ]
+    stdout, stderr = await run_probe(probe_cmd)
+    try:
+        stream = json.loads(stdout)["streams"][0]
+        width, height = int(stream["width"]), int(stream["height"])
+    except (ValueError, KeyError, IndexError, TypeError):
+        print(f"Could not probe video size, assuming 1280x720: {stderr}")
+        return 1280, 720
+
+    rotation = stream.get("tags", {}).get("rotate", 0)
+    for side_data in stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    # FFmpegは回転を適用してからフィルタに渡すので縦横を入れ替える
+    if abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+    return width, height
+
+async def probe_duration(path: str) -> float | None:
+    """ファイルの長さ(秒)を返す"""
+    probe_cmd = [
+        "ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path
+    ]
+    stdout, _ = await run_probe(probe_cmd)
+    try:
+        return float(stdout.strip())
+    except ValueError:
+        return None
+
+async def probe_has_audio(path: str) -> bool:
+    """音声ストリームがあるかを返す"""
+    probe_cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "a",
+        "-show_entries", "stream=index", "-of", "json", path
+    ]
+    stdout, _ = await run_probe(probe_cmd)
+    try:
+        return len(json.loads(stdout).get("streams", [])) > 0
+    except ValueError:
+        return False
+
+async def probe_audio_codec(path: str) -> str:
+    """最初の音声ストリームのcodec_nameを返す（音声が無ければ空文字）"""
+    probe_cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "stream=codec_name", "-of", "csv=p=0", path
+    ]
+    stdout, _ = await run_probe(probe_cmd)
+    return stdout.strip()
+
+# エラー表示用に保持するFFmpeg stderrの末尾サイズ
+STDERR_TAIL_BYTES = 8192
+FFMPEG_TIMEOUT = 300
+
+# FFmpegの同時実行数とジョブごとのスレッド数（合計がコア数程度になるようにする）
+CPU_COUNT = os.cpu_count() or 1
+FFMPEG_CONCURRENCY = max(1, int(os.environ.get("FFMPEG_CONCURRENCY", str(CPU_COUNT // 4))))
+THREADS_PER_JOB = max(1, CPU_COUNT // FFMPEG_CONCURRENCY)
+JOB_SEM = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", "20"))
+
+def filter_thread_args() -> list[str]:
+    """テロップ焼き込み時のフィルタグラフのスレッド数（ジョブの割り当て分だけ使う）"""
+    return [
+        "-filter_threads", str(THREADS_PER_JOB),
+        "-filter_complex_threads", str(THREADS_PER_JOB),
+    ]
+
+async def execute_ffmpeg(cmd: list[str], timeout: float = FFMPEG_TIMEOUT) -> tuple[int, str]:
+    """FFmpegを非同期で実行して (returncode, stderrの末尾) を返す"""
+    async with JOB_SEM:
+        return await _execute_ffmpeg(cmd, timeout)
+
+async def _execute_ffmpeg(cmd: list[str], timeout: float) -> tuple[int, str]:
+    # stderrは無名の一時ファイルに書かせて、終了後に末尾だけ読む（進捗行でイベントループを起こさない）
+    with tempfile.TemporaryFile(dir=WORK_DIR) as errlog:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=errlog
+        )
+        try:
+            returncode = await asyncio.wait_for(proc.wait(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            proc.kill()
+            await proc.wait()
+            raise
+        errlog.seek(max(0, os.fstat(errlog.fileno()).st_size - STDERR_TAIL_BYTES))
+        return returncode, errlog.read().decode(errors="replace")
+
+async def run_ffmpeg(cmd: list[str], label: str = "FFmpeg") -> bool:
+    """FFmpegコマンドを実行して成功したかを返す"""
+    print(f"Running {label} command: {' '.join(cmd)}")
+    try:
+        returncode, stderr_tail = await execute_ffmpeg(cmd)
+    except asyncio.TimeoutError:
+        print(f"{label} timeout")
+        return False
+    if returncode != 0:
+        print(f"{label} error: {stderr_tail}")
+        return False
+    return True
 
 # === Core Functions ===
 
-def create_video_from_image(image_path: str, audio_path: str, output_path: str) -> bool:
+async def create_video_from_image(
+    image_path: str,
+    audio_path: str,
+    output_path: str,
+    encode_speed: str | None = None
+) -> bool:
     try:
-        cmd = ["ffmpeg", "-y", "-loop", "1", "-i", image_path, "-i", audio_path, "-c:v", "libx264", "-tune", "stillimage", "-c:a", "aac", "-b:a", "192k", "-pix_fmt", "yuv420p", "-shortest", output_path]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        return result.returncode == 0
+        hw_args, vf, codec_args = _video_encoder_args(hw_decode=False, preset=encode_speed)
+        cmd = ["ffmpeg", "-y"] + hw_args + ["-loop", "1", "-i", image_path, "-i", audio_path]
+        if vf:
+            cmd.extend(["-vf", vf])
+        cmd += codec_args + ["-c:a", "aac", "-b:a", "192k", "-threads", str(THREADS_PER_JOB), "-shortest"]
+        cmd += faststart_args(output_path) + [output_path]
+        return await run_ffmpeg(cmd)
     except Exception as e:
         print(f"FFmpeg error: {e}")
         return False
 
-def combine_video_audio(video_path: str, audio_path: str, output_path: str) -> bool:
-    """動画と音声を合成（元の音声を保持してBGMをミックス）"""
+async def replace_audio(video_path: str, audio_path: str, output_path: str) -> bool:
+    """動画の音声を差し替える（AACならデコードせずにそのまま多重化する）"""
+    if await probe_audio_codec(audio_path) == "aac":
+        codec_args = ["-c", "copy"]
+    else:
+        codec_args = ["-c:v", "copy", "-c:a", "aac", "-threads", str(THREADS_PER_JOB)]
+    cmd = [
+        "ffmpeg", "-y",
+        "-i", video_path,
+        "-i", audio_path,
+        "-map", "0:v:0",
+        "-map", "1:a:0",
+    ] + codec_args + ["-shortest"] + faststart_args(output_path) + [output_path]
+    return await run_ffmpeg(cmd)
+
+async def combine_video_audio(video_path: str, audio_path: str, output_path: str, audio_mode: str = "mix") -> bool:
+    """動画と音声を合成（mixは元の音声を保持してBGMをミックス、replaceは音声を差し替え）"""
     try:
-        probe_cmd = [
-            "ffprobe", "-v", "error", "-select_streams", "a",
-            "-show_entries", "stream=index", "-of", "csv=p=0", video_path
-        ]
-        probe_result = subprocess.run(probe_cmd, capture_output=True, text=True)
-        has_audio = bool(probe_result.stdout.strip())
-
-        print(f"Video has audio track: {has_audio}")
-
-        if has_audio:
-            cmd = [
-                "ffmpeg", "-y",
-                "-i", video_path,
-                "-i", audio_path,
-                "-filter_complex",
-                "[0:a]aformat=sample_fmts=fltp:sample_rates=44100:channel_layouts=stereo,volume=1.0[voice];"
-                "[1:a]aformat=sample_fmts=fltp:sample_rates=44100:channel_layouts=stereo,volume=0.10[bgm];"
-                "[voice][bgm]amix=inputs=2:duration=first:dropout_transition=2[aout]",
-                "-map", "0:v",
-                "-map", "[aout]",
-                "-c:v", "copy",
-                "-c:a", "aac",
-                "-b:a", "192k",
-                "-shortest",
-                output_path
-            ]
-        else:
-            cmd = [
-                "ffmpeg", "-y",
-                "-i", video_path,
-                "-i", audio_path,
-                "-map", "0:v",
-                "-map", "1:a",
-                "-c:v", "copy",
-                "-c:a", "aac",
-                "-shortest",
-                output_path
-            ]
-
-        print(f"Running FFmpeg command: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-
-        if result.returncode != 0:
-            print(f"FFmpeg error: {result.stderr}")
-            return False
+        if audio_mode == "replace":
+            return await replace_audio(video_path, audio_path, output_path)
 
-        return True
-    except subprocess.TimeoutExpired:
+        # 動画に音声トラックが無ければミックスできないので音声を直接マップする
+        if not await probe_has_audio(video_path):
+            print("Video has no audio track, mapping audio directly")
+            return await replace_audio(video_path, audio_path, output_path)
+
+        mix_cmd = [
+            "ffmpeg", "-y",
+            "-i", video_path,
+            "-i", audio_path,
+            "-filter_complex",
+            "[0:a]aformat=sample_fmts=fltp:sample_rates=44100:channel_layouts=stereo,volume=1.0[voice];"
+            "[1:a]aformat=sample_fmts=fltp:sample_rates=44100:channel_layouts=stereo,volume=0.10[bgm];"
+            "[voice][bgm]amix=inputs=2:duration=first:dropout_transition=2[aout]",
+            "-map", "0:v",
+            "-map", "[aout]",
+            "-c:v", "copy",
+            "-c:a", "aac",
+            "-b:a", "192k",
+            "-threads", str(THREADS_PER_JOB),
+            "-shortest",
+        ] + faststart_args(output_path) + [output_path]
+
+        return await run_ffmpeg(mix_cmd)
+    except asyncio.TimeoutError:
         print("FFmpeg timeout")
         return False
     except Exception as e:
         print(f"FFmpeg error: {e}")
         return False
 
-def add_captions_to_video(video_path: str, output_path: str, captions: list[Caption], styles: CaptionStyles) -> bool:
+async def add_captions_to_video(
+    video_path: str,
+    output_path: str,
+    captions: list[Caption],
+    styles: CaptionStyles,
+    encode_speed: str | None = None
+) -> bool:
     """動画にテロップを追加"""
     try:
-        drawtext_filter = build_drawtext_filter(captions, styles)
-
-        cmd = [
-            "ffmpeg", "-y",
-            "-i", video_path,
-            "-vf", drawtext_filter,
-            "-c:a", "copy",
-            output_path
-        ]
-
-        print(f"Running FFmpeg caption command: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-
-        if result.returncode != 0:
-            print(f"FFmpeg caption error: {result.stderr}")
-            return False
-
-        return True
+        # テロップが無ければ再エンコードせずにコピーするだけ
+        if not captions:
+            return await run_ffmpeg(["ffmpeg", "-y", "-i", video_path, "-c", "copy"] + faststart_args(output_path) + [output_path], "FFmpeg caption")
+
+        fd, ass_path = tempfile.mkstemp(suffix=".ass", dir=WORK_DIR)
+        os.close(fd)
+        try:
+            caption_filter = await build_caption_filter(captions, styles, video_path, ass_path)
+            hw_args, vf, codec_args = _video_encoder_args(caption_filter, preset=encode_speed)
+            cmd = (
+                ["ffmpeg", "-y"] + filter_thread_args() + hw_args
+                + ["-i", video_path, "-vf", vf]
+                + codec_args
+                + ["-threads", str(THREADS_PER_JOB), "-c:a", "copy"]
+                + faststart_args(output_path) + [output_path]
+            )
+            return await run_ffmpeg(cmd, "FFmpeg caption")
+        finally:
+            os.remove(ass_path)
     except Exception as e:
         print(f"FFmpeg caption error: {e}")
         return False
 
-def combine_video_voice_bgm_captions(
+async def combine_video_voice_bgm_captions(
     video_path: str,
     voice_path: str | None,
     bgm_path: str | None,
     output_path: str,
     captions: list[Caption],
-    styles: CaptionStyles
+    styles: CaptionStyles,
+    hardcode: bool = True,
+    encode_speed: str | None = None
 ) -> bool:
     """動画 + 音声(voice) + BGM + テロップを全て合成"""
+    ass_path = None
     try:
-        # テロップフィルタを構築
-        drawtext_filter = build_drawtext_filter(captions, styles) if captions else ""
-        has_captions = bool(drawtext_filter)
+        # 焼き込み不要で字幕トラックを持てる出力形式なら、動画は再エンコードしない
+        output_format = os.path.splitext(output_path)[1].lstrip(".").lower()
+        subtitle_codec = None if hardcode else SOFT_SUBTITLE_CODECS.get(output_format)
+
+        # テロップはASSファイルに書き出してassフィルタ1つで焼き込む
+        caption_filter = ""
+        if captions:
+            fd, ass_path = tempfile.mkstemp(suffix=".ass", dir=WORK_DIR)
+            os.close(fd)
+            if subtitle_codec:
+                width, height = await probe_video_size(video_path)
+                build_ass_file(captions, styles, ass_path, width, height)
+            else:
+                caption_filter = await build_caption_filter(captions, styles, video_path, ass_path)
+        has_captions = bool(caption_filter)
+        has_soft_subs = bool(captions) and subtitle_codec is not None
         has_voice = voice_path and os.path.exists(voice_path)
         has_bgm = bgm_path and os.path.exists(bgm_path)
 
-        print(f"Processing: captions={has_captions}, voice={has_voice}, bgm={has_bgm}")
+        print(f"Processing: captions={has_captions}, soft_subs={has_soft_subs}, voice={has_voice}, bgm={has_bgm}")
 
-        # 入力ファイルリスト
-        inputs = ["-i", video_path]
+        # 入力ファイルリスト（テロップを焼き込む場合はGPUエンコーダに合わせてデコード）
+        if has_captions:
+            hw_args, caption_vf, video_codec_args = _video_encoder_args(caption_filter, preset=encode_speed)
+            hw_args = filter_thread_args() + hw_args
+        else:
+            hw_args, caption_vf, video_codec_args = [], "", ["-c:v", "copy"]
+        inputs = hw_args + ["-i", video_path]
         input_count = 1
         voice_idx = None
         bgm_idx = None
@@ -341,6 +976,11 @@ def combine_video_voice_bgm_captions(
             bgm_idx = input_count
             input_count += 1
 
+        if has_soft_subs:
+            inputs.extend(["-i", ass_path])
+            subs_idx = input_count
+            input_count += 1
+
         # フィルタ構築
         filter_parts = []
         video_out = "0:v"
@@ -348,17 +988,14 @@ def combine_video_voice_bgm_captions(
 
         # テロップフィルタ
         if has_captions:
-            filter_parts.append(f"[0:v]{drawtext_filter}[vout]")
+            filter_parts.append(f"[0:v]{caption_vf}[vout]")
             video_out = "[vout]"
 
-        # 動画に音声トラックがあるか確認
-        probe_cmd = [
-            "ffprobe", "-v", "error", "-select_streams", "a",
-            "-show_entries", "stream=index", "-of", "csv=p=0", video_path
-        ]
-        probe_result = subprocess.run(probe_cmd, capture_output=True, text=True)
-        video_has_audio = bool(probe_result.stdout.strip())
-        print(f"Video has audio track: {video_has_audio}")
+        # 動画の元音声の有無が必要なのはvoiceが無くBGMがある場合だけなので、そのときだけffprobeで確認
+        video_has_audio = False
+        if not has_voice and has_bgm:
+            video_has_audio = await probe_has_audio(video_path)
+            print(f"Video has audio track: {video_has_audio}")
 
         # 音声フィルタ
         if has_voice and has_bgm:
@@ -372,7 +1009,7 @@ def combine_video_voice_bgm_captions(
         elif has_voice:
             # 外部音声ファイルのみ
             audio_out = f"{voice_idx}:a"
-        elif video_has_audio and has_bgm:
+        elif video_has_audio:
             # 動画の元音声 + BGM をミックス
             filter_parts.append(
                 f"[0:a]aformat=sample_fmts=fltp:sample_rates=44100:channel_layouts=stereo,volume=1.0[origaudio];"
@@ -380,12 +1017,12 @@ def combine_video_voice_bgm_captions(
                 f"[origaudio][bgm]amix=inputs=2:duration=first:dropout_transition=2[aout]"
             )
             audio_out = "[aout]"
-        elif video_has_audio:
-            # 動画の元音声のみ
-            audio_out = "0:a"
         elif has_bgm:
             # BGMのみ
             audio_out = f"{bgm_idx}:a"
+        else:
+            # 動画の元音声のみ（音声トラックが無ければ ? で無視される）
+            audio_out = "0:a?"
 
         # コマンド構築
         cmd = ["ffmpeg", "-y"] + inputs
@@ -402,63 +1039,248 @@ def combine_video_voice_bgm_captions(
         if audio_out:
             cmd.extend(["-map", audio_out])
 
+        if has_soft_subs:
+            cmd.extend(["-map", f"{subs_idx}:s"])
+
         # エンコード設定
-        if has_captions:
-            cmd.extend(["-c:v", "libx264"])
-        else:
-            cmd.extend(["-c:v", "copy"])
+        cmd.extend(video_codec_args)
+        cmd.extend(["-threads", str(THREADS_PER_JOB)])
 
         if audio_out:
             cmd.extend(["-c:a", "aac", "-b:a", "192k"])
 
-        cmd.extend(["-shortest", output_path])
-
-        print(f"Running FFmpeg command: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-
-        if result.returncode != 0:
-            print(f"FFmpeg error: {result.stderr}")
-            return False
+        if has_soft_subs:
+            cmd.extend(["-c:s", subtitle_codec])
+            # -shortestは字幕ストリームが先に終わると動画ごと切れてしまうので動画の長さで切る
+            duration = await probe_duration(video_path)
+            if duration:
+                cmd.extend(["-t", str(duration)])
+        else:
+            cmd.append("-shortest")
 
-        return True
+        cmd += faststart_args(output_path) + [output_path]
+        return await run_ffmpeg(cmd)
     except Exception as e:
         print(f"FFmpeg error: {e}")
         return False
+    finally:
+        if ass_path and os.path.exists(ass_path):
+            os.remove(ass_path)
+
+# === Scratch Files ===
+
+# 入力ファイル用の一時ファイルは拡張子ごとにプールして使い回す
+SCRATCH_DIR = os.path.join(WORK_DIR, "ffmpeg_scratch")
+SCRATCH_POOL_SIZE = 64
+SCRATCH_PREFILL = 16
+SCRATCH_POOLS: dict[str, queue.Queue] = {}
+
+def remove_files(*paths: str | None):
+    """一時ファイルを削除（無ければ何もしない）"""
+    for path in paths:
+        if not path:
+            continue
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def _scratch_pool(suffix: str) -> queue.Queue:
+    pool = SCRATCH_POOLS.get(suffix)
+    if pool is None:
+        pool = SCRATCH_POOLS[suffix] = queue.Queue(maxsize=SCRATCH_POOL_SIZE)
+    return pool
+
+def _new_scratch(suffix: str) -> str:
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=SCRATCH_DIR)
+    os.close(fd)
+    return path
+
+def acquire_scratch(suffix: str) -> str:
+    """一時ファイルのパスをプールから取り出す（空なら新しく作る）"""
+    try:
+        return _scratch_pool(suffix).get_nowait()
+    except queue.Empty:
+        return _new_scratch(suffix)
+
+# これより大きい入力（元動画など）は使い回されにくいのでジョブ後にページキャッシュから落とす
+PAGE_CACHE_DROP_BYTES = 64 << 20
+
+def drop_page_cache(path: str):
+    """ファイルのページキャッシュを解放するようカーネルに伝える"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def release_scratch(*paths: str | None):
+    """一時ファイルを空にしてプールに戻す（プールが一杯なら削除）。ファイル操作が重いのでスレッドから呼ぶ"""
+    for path in paths:
+        if not path:
+            continue
+        try:
+            st = os.stat(path)
+            if st.st_nlink > 1:
+                # URLキャッシュとハードリンクしているので中身は消さずにリンクだけ外す
+                if st.st_size >= PAGE_CACHE_DROP_BYTES:
+                    drop_page_cache(path)
+                os.remove(path)
+                open(path, "wb").close()
+            else:
+                os.truncate(path, 0)
+            _scratch_pool(os.path.splitext(path)[1]).put_nowait(path)
+        except (OSError, queue.Full):
+            remove_files(path)
+
+async def prepare_scratch_pool():
+    # 前回の残り（書きかけの出力も含む）は捨ててから作り直す
+    for path in (SCRATCH_DIR, RENDER_DIR, INFLIGHT_DIR):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+    for suffix in (".mp4", ".mp3", ".png"):
+        pool = _scratch_pool(suffix)
+        for _ in range(SCRATCH_PREFILL):
+            pool.put_nowait(_new_scratch(suffix))
+
+# === Output Cleanup ===
+
+# 出力ファイルは作成順に並べて持っておき、古いものから消す（毎回ディレクトリを走査しない）
+OUTPUT_TTL = 3600
+OUTPUT_INDEX: deque[tuple[float, str]] = deque()
+
+def record_output(output_path: str):
+    """出力ファイルを削除対象のインデックスに登録する"""
+    OUTPUT_INDEX.append((time.time(), output_path))
+
+def expired_outputs() -> list[str]:
+    """OUTPUT_TTLより古い出力ファイルをインデックスから外して返す"""
+    expires = time.time() - OUTPUT_TTL
+    paths = []
+    while OUTPUT_INDEX and OUTPUT_INDEX[0][0] < expires:
+        paths.append(OUTPUT_INDEX.popleft()[1])
+    return paths
+
+def cleanup_old_files():
+    """OUTPUT_TTLより古い出力ファイルを削除"""
+    remove_files(*expired_outputs())
+
+async def _post_job_cleanup(*paths: str | None):
+    # インデックスの操作はイベントループ上で行い、unlinkだけまとめてスレッドに逃がす
+    await asyncio.to_thread(remove_files, *paths, *expired_outputs())
+
+async def seed_output_index():
+    # 再起動前の出力ファイルは起動時に一度だけ走査して登録する
+    entries = []
+    with os.scandir(OUTPUT_DIR) as it:
+        for entry in it:
+            if entry.is_file():
+                entries.append((entry.stat().st_mtime, entry.path))
+    OUTPUT_INDEX.extend(sorted(entries))
+    cleanup_old_files()
+
+# === Job Queue ===
+
+# job_id -> {"state": pending|running|done|failed, "output_url": ..., "error": ...}
+JOBS: dict[str, dict] = {}
+JOB_HISTORY_LIMIT = 1000
+JOB_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=MAX_QUEUED_JOBS)
+# ワーカーはダウンロードも含めてジョブ全体を処理するので、FFmpegの同時実行数より多く動かす
+# （FFmpegの実行自体はJOB_SEMで絞るので、前のジョブのエンコード中に次のジョブがダウンロードできる）
+JOB_WORKERS = max(1, int(os.environ.get("JOB_WORKERS", str(4 * FFMPEG_CONCURRENCY))))
+worker_tasks: list[asyncio.Task] = []
+
+def enqueue_job(job_id: str, run, output_path: str) -> CombineResponse:
+    """ジョブをキューに積んですぐにjob_idを返す（キューが一杯なら429）"""
+    output_url = f"/download/{os.path.basename(output_path)}"
+    JOBS[job_id] = {"state": "pending", "output_url": output_url, "error": None}
+    try:
+        JOB_QUEUE.put_nowait((job_id, run, output_path))
+    except asyncio.QueueFull:
+        del JOBS[job_id]
+        raise HTTPException(status_code=429, detail="Too many jobs queued, please retry later")
+
+    # 古い完了済みジョブの状態は捨てる
+    while len(JOBS) > JOB_HISTORY_LIMIT:
+        oldest = next(iter(JOBS))
+        if JOBS[oldest]["state"] in ("pending", "running"):
+            break
+        del JOBS[oldest]
+
+    return CombineResponse(success=True, job_id=job_id, message="Job queued", output_url=output_url)
+
+async def job_worker():
+    """キューからジョブを取り出して順に処理"""
+    while True:
+        job_id, run, output_path = await JOB_QUEUE.get()
+        job = JOBS.get(job_id, {})
+        job["state"] = "running"
+        render_path = os.path.join(RENDER_DIR, os.path.basename(output_path))
+        try:
+            await run(render_path)
+            # 書き上がってから公開するので/downloadが書きかけのファイルを返すことはない
+            os.replace(render_path, output_path)
+            record_output(output_path)
+            job["state"] = "done"
+        except HTTPException as e:
+            job.update(state="failed", error=e.detail)
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            job.update(state="failed", error=str(e))
+        finally:
+            await _post_job_cleanup(render_path)
+            JOB_QUEUE.task_done()
+
+async def start_job_workers():
+    for _ in range(JOB_WORKERS):
+        worker_tasks.append(asyncio.create_task(job_worker()))
 
 # === API Endpoints ===
 
 @app.get("/")
 async def health_check():
-    return {"status": "ok", "ffmpeg_version": get_ffmpeg_version()}
+    # 頻繁に叩かれるのでjsonable_encoderを通さずに直接orjsonで返す
+    return ORJSONResponse({"status": "ok", "ffmpeg_version": get_ffmpeg_version()})
+
+@app.get("/status/{job_id}", response_model=JobStatusResponse)
+async def job_status(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JobStatusResponse(job_id=job_id, **job)
 
 @app.post("/combine", response_model=CombineResponse)
-async def combine_video_and_audio(request: CombineRequest, background_tasks: BackgroundTasks):
+async def combine_video_and_audio(request: CombineRequest, http_request: Request):
     job_id = str(uuid.uuid4())[:8]
-    video_path = os.path.join(TEMP_DIR, f"{job_id}_video.mp4")
-    audio_path = os.path.join(TEMP_DIR, f"{job_id}_audio.mp3")
     output_path = os.path.join(OUTPUT_DIR, f"{job_id}_output.{request.output_format}")
-    try:
-        if not await download_file(request.video_url, video_path):
-            raise HTTPException(status_code=400, detail="Failed to download video")
-        if not await download_file(request.audio_url, audio_path):
-            raise HTTPException(status_code=400, detail="Failed to download audio")
-        if not combine_video_audio(video_path, audio_path, output_path):
-            raise HTTPException(status_code=500, detail="FFmpeg processing failed")
-        background_tasks.add_task(lambda: os.remove(video_path) if os.path.exists(video_path) else None)
-        background_tasks.add_task(lambda: os.remove(audio_path) if os.path.exists(audio_path) else None)
-        return CombineResponse(success=True, job_id=job_id, message="Video combined", output_url=f"/download/{job_id}_output.{request.output_format}")
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+
+    async def run(output_path: str):
+        client = http_request.app.state.http
+        video_path = acquire_scratch(".mp4")
+        audio_path = acquire_scratch(url_suffix(request.audio_url, AUDIO_SUFFIXES, ".mp3"))
+        try:
+            # 動画と音声は同時にダウンロード
+            video_ok, audio_ok = await gather_downloads(
+                download_file(request.video_url, video_path, client),
+                download_file(request.audio_url, audio_path, client),
+            )
+            if not video_ok:
+                raise HTTPException(status_code=400, detail="Failed to download video")
+            if not audio_ok:
+                raise HTTPException(status_code=400, detail="Failed to download audio")
+            if not await combine_video_audio(video_path, audio_path, output_path, request.audio_mode):
+                raise HTTPException(status_code=500, detail="FFmpeg processing failed")
+        finally:
+            await asyncio.to_thread(release_scratch, video_path, audio_path)
+
+    return enqueue_job(job_id, run, output_path)
 
 @app.post("/combine-with-captions", response_model=CombineResponse)
-async def combine_with_captions(request: CombineWithCaptionsRequest, background_tasks: BackgroundTasks):
+async def combine_with_captions(request: CombineWithCaptionsRequest, http_request: Request):
     """動画 + 音声(voice) + BGM + テロップを合成"""
     job_id = str(uuid.uuid4())[:8]
-    video_path = os.path.join(TEMP_DIR, f"{job_id}_video.mp4")
-    voice_path = os.path.join(TEMP_DIR, f"{job_id}_voice.mp3") if request.voice_url else None
-    bgm_path = os.path.join(TEMP_DIR, f"{job_id}_bgm.mp3") if request.audio_url else None
     output_path = os.path.join(OUTPUT_DIR, f"{job_id}_output.{request.output_format}")
 
     print(f"=== combine-with-captions request ===")
@@ -470,75 +1292,93 @@ async def combine_with_captions(request: CombineWithCaptionsRequest, background_
         cap_preview = cap.text[:30] if len(cap.text) > 30 else cap.text
         print(f"  caption[{i}]: text='{cap_preview}...' start={cap.start_time} end={cap.end_time} pos={cap.position}")
 
-    try:
-        if not await download_file(request.video_url, video_path):
-            raise HTTPException(status_code=400, detail="Failed to download video")
-        print(f"Video downloaded: {os.path.exists(video_path)}, size: {os.path.getsize(video_path) if os.path.exists(video_path) else 0}")
-
-        if request.voice_url and voice_path:
-            if not await download_file(request.voice_url, voice_path):
-                raise HTTPException(status_code=400, detail="Failed to download voice audio")
-            print(f"Voice downloaded: {os.path.exists(voice_path)}, size: {os.path.getsize(voice_path) if os.path.exists(voice_path) else 0}")
-
-        if request.audio_url and bgm_path:
-            if not await download_file(request.audio_url, bgm_path):
-                raise HTTPException(status_code=400, detail="Failed to download BGM audio")
-            print(f"BGM downloaded: {os.path.exists(bgm_path)}, size: {os.path.getsize(bgm_path) if os.path.exists(bgm_path) else 0}")
-
-        if not combine_video_voice_bgm_captions(
-            video_path,
-            voice_path,
-            bgm_path,
-            output_path,
-            request.captions,
-            request.caption_styles
-        ):
-            raise HTTPException(status_code=500, detail="FFmpeg processing failed")
-
-        background_tasks.add_task(lambda: os.remove(video_path) if os.path.exists(video_path) else None)
-        if voice_path:
-            background_tasks.add_task(lambda: os.remove(voice_path) if os.path.exists(voice_path) else None)
-        if bgm_path:
-            background_tasks.add_task(lambda: os.remove(bgm_path) if os.path.exists(bgm_path) else None)
-
-        return CombineResponse(
-            success=True,
-            job_id=job_id,
-            message="Video with captions created",
-            output_url=f"/download/{job_id}_output.{request.output_format}"
-        )
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    async def run(output_path: str):
+        client = http_request.app.state.http
+        video_path = acquire_scratch(".mp4")
+        voice_path = acquire_scratch(".mp3") if request.voice_url else None
+        bgm_path = acquire_scratch(".mp3") if request.audio_url else None
+        try:
+            # 動画・音声・BGMは同時にダウンロード
+            video_ok, voice_ok, bgm_ok = await gather_downloads(
+                download_file(request.video_url, video_path, client),
+                download_file(request.voice_url, voice_path, client) if request.voice_url and voice_path else _noop(True),
+                download_file(request.audio_url, bgm_path, client) if request.audio_url and bgm_path else _noop(True),
+            )
+
+            if not video_ok:
+                raise HTTPException(status_code=400, detail="Failed to download video")
+            print(f"Video downloaded: {os.path.exists(video_path)}, size: {os.path.getsize(video_path) if os.path.exists(video_path) else 0}")
+
+            if request.voice_url and voice_path:
+                if not voice_ok:
+                    raise HTTPException(status_code=400, detail="Failed to download voice audio")
+                print(f"Voice downloaded: {os.path.exists(voice_path)}, size: {os.path.getsize(voice_path) if os.path.exists(voice_path) else 0}")
+
+            if request.audio_url and bgm_path:
+                if not bgm_ok:
+                    raise HTTPException(status_code=400, detail="Failed to download BGM audio")
+                print(f"BGM downloaded: {os.path.exists(bgm_path)}, size: {os.path.getsize(bgm_path) if os.path.exists(bgm_path) else 0}")
+
+            if not await combine_video_voice_bgm_captions(
+                video_path,
+                voice_path,
+                bgm_path,
+                output_path,
+                request.captions,
+                request.caption_styles,
+                request.hardcode,
+                request.encode_speed
+            ):
+                raise HTTPException(status_code=500, detail="FFmpeg processing failed")
+        finally:
+            await asyncio.to_thread(release_scratch, video_path, voice_path, bgm_path)
+
+    return enqueue_job(job_id, run, output_path)
 
 @app.post("/image-to-video", response_model=CombineResponse)
-async def image_to_video(request: ImageToVideoRequest, background_tasks: BackgroundTasks):
+async def image_to_video(request: ImageToVideoRequest, http_request: Request):
     job_id = str(uuid.uuid4())[:8]
-    image_path = os.path.join(TEMP_DIR, f"{job_id}_image.png")
-    audio_path = os.path.join(TEMP_DIR, f"{job_id}_audio.mp3")
     output_path = os.path.join(OUTPUT_DIR, f"{job_id}_output.{request.output_format}")
-    try:
-        if not await download_file(request.image_url, image_path):
-            raise HTTPException(status_code=400, detail="Failed to download image")
-        if not await download_file(request.audio_url, audio_path):
-            raise HTTPException(status_code=400, detail="Failed to download audio")
-        if not create_video_from_image(image_path, audio_path, output_path):
-            raise HTTPException(status_code=500, detail="FFmpeg processing failed")
-        background_tasks.add_task(lambda: os.remove(image_path) if os.path.exists(image_path) else None)
-        background_tasks.add_task(lambda: os.remove(audio_path) if os.path.exists(audio_path) else None)
-        return CombineResponse(success=True, job_id=job_id, message="Video created", output_url=f"/download/{job_id}_output.{request.output_format}")
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+
+    async def run(output_path: str):
+        client = http_request.app.state.http
+        image_path = acquire_scratch(".png")
+        audio_path = acquire_scratch(".mp3")
+        try:
+            # 画像と音声は同時にダウンロード
+            image_ok, audio_ok = await gather_downloads(
+                download_file(request.image_url, image_path, client),
+                download_file(request.audio_url, audio_path, client),
+            )
+            if not image_ok:
+                raise HTTPException(status_code=400, detail="Failed to download image")
+            if not audio_ok:
+                raise HTTPException(status_code=400, detail="Failed to download audio")
+            if not await create_video_from_image(image_path, audio_path, output_path, request.encode_speed):
+                raise HTTPException(status_code=500, detail="FFmpeg processing failed")
+        finally:
+            await asyncio.to_thread(release_scratch, image_path, audio_path)
+
+    return enqueue_job(job_id, run, output_path)
 
 @app.get("/download/{filename}")
 async def download_file_endpoint(filename: str):
     filepath = os.path.join(OUTPUT_DIR, filename)
-    if not os.path.exists(filepath):
+    # 存在確認を兼ねてstatは1回だけ取り、FileResponseにも渡す
+    try:
+        stat_result = os.stat(filepath)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(filepath, media_type="video/mp4", filename=filename)
+    if SERVE_VIA_XACCEL:
+        # ファイル本体はnginxにsendfileで返させる
+        return Response(
+            headers={
+                "X-Accel-Redirect": f"{XACCEL_PREFIX}{filename}",
+                "Content-Disposition": f'attachment; filename="{filename}"',
+            },
+            media_type="video/mp4",
+        )
+    return OutputFileResponse(filepath, media_type="video/mp4", filename=filename, stat_result=stat_result)
 
 if __name__ == "__main__":
     import uvicorn